@@ -1,23 +1,95 @@
+import asyncio
 import os
-import re
-
-from numpy.lib.function_base import iterable
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
+import pathlib
+import tempfile
+
+import aiohttp
+import lxml.etree
+import lxml.html
+import numpy as np
 import pandas as pd
-from dateutil import parser, rrule
-from datetime import datetime, time, date
-from tqdm import tqdm
-import time
+import pyarrow
+import pyarrow.csv
+from tqdm.asyncio import tqdm as atqdm
+
+# Maximum number of history pages requested from Wunderground at the same time
+MAX_CONCURRENT_REQUESTS = 64
+# Seconds an idle connection is kept open for reuse, long enough to outlast a retry backoff
+KEEPALIVE_TIMEOUT = 60
+# Seconds to wait for a single history page before retrying
+REQUEST_TIMEOUT = 20
+# Longest wait in seconds between two retries of a history page
+MAX_BACKOFF_TIME = 60
+# Times a history page is tried before giving up
+MAX_ATTEMPTS = 8
+# Wunderground refuses requests without a browser-like user agent
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0 Safari/537.36"
+# All data is saved here
+DATA_DIR = pathlib.Path('./data')
+# Every scraped history page is kept here, so that re-runs do not have to scrape it again
+CACHE_DIR = DATA_DIR / 'cache'
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+# Rows of the raw CSV converted to Excel at a time
+EXCEL_CHUNK_ROWS = 10000
+# The hourly observation table of a history page
+OBSERVATION_TABLE = lxml.etree.XPath('//lib-city-history-observation//table')
+# The groups the Wunderground conditions are generalized into
+CONDITION_GROUPS = ['Other', 'Rain', 'Cloudy', 'Sun']
+# Keywords putting a condition in a group (index in CONDITION_GROUPS), the first matching keyword wins
+CONDITION_KEYWORDS = [('rain', 1), ('drizzle', 1), ('misty', 1), ('storm', 1), ('thunder', 1),
+                      ('cloudy', 2), ('fog', 2),
+                      ('fair', 3)]
+
+class NoObservationsError(Exception):
+    """Raised when a history page does not have the hourly observation table."""
+
+def atomicWrite(path, text):
+    """Writes text to a file so that it is either written completely or not at all.
 
-def getWundergroundData(station, day, month, year):
+    Args:
+        path (pathlib.Path): the file to write
+        text (string): the text to write
+    """
+    path.parent.mkdir(exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def parseObservations(html, full_url, date_insert):
+    """Builds a data frame from the observation table of a history page.
+
+    Args:
+        html (string): the history page
+        full_url (string): where the page is from, for error messages
+        date_insert (string): the date of the page, yyyy-m-d
+
+    returns:
+        Pandas Dataframe with the observations on the page, without rows if the day has none.
+    """
+    # Parsing the page once and only building a data frame from the observation table
+    page = lxml.html.fromstring(html)
+    tables = OBSERVATION_TABLE(page)
+    if not tables:
+        raise NoObservationsError("No observation table for {} at {}".format(date_insert, full_url))
+    table = tables[0]
+    columns = [th.text_content().strip() for th in table.xpath('.//th')]
+    rows = [[td.text_content().strip() or None for td in tr.xpath('./td')] for tr in table.xpath('.//tr[td]')]
+    if not rows:
+        # A day without recorded observations is not an error, it just adds no rows
+        print("No observations for {} at {}, skipping the day".format(date_insert, full_url))
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+async def getWundergroundData(session, station, day, month, year):
     """
     Function to return a data frame of hour-level weather data for a single Wunderground PWS station.
     
     Args:
+        session (aiohttp.ClientSession): HTTP session used for the request
         station (string): Station code from the Wunderground website
         day (int): Day of month for which data is requested
         month (int): Month for which data is requested
@@ -28,21 +100,30 @@ def getWundergroundData(station, day, month, year):
     """
     url = "https://www.wunderground.com/history/daily/np/kathmandu/{station}/date/{year}-{month}-{day}"
     full_url = url.format(station=station, day=day, month=month, year=year)
+    date_insert = "{year}-{month}-{day}".format(day=day, month=month, year=year)
 
-    chrome_options = Options()  
-    chrome_options.add_argument("--headless") 
-    driver = webdriver.Chrome("/usr/bin/chromedriver", options=chrome_options)
-    driver.get(full_url)
-
-    tables = WebDriverWait(driver,20).until(EC.presence_of_all_elements_located((By.CSS_SELECTOR, "table")))
-    for table in tables:
-        dataframe = pd.read_html(table.get_attribute('outerHTML'))
+    cache_path = CACHE_DIR / station / '{year}-{month:02d}-{day:02d}.html'.format(day=day, month=month, year=year)
+    if cache_path.exists():
+        with open(cache_path, encoding='utf-8') as file:
+            html = file.read()
+        try:
+            dataframe = parseObservations(html, full_url, date_insert)
+        except NoObservationsError:
+            # Removing the unusable page, so that the next attempt fetches it again
+            cache_path.unlink()
+            raise
+    else:
+        async with session.get(full_url) as response:
+            response.raise_for_status()
+            html = await response.text()
+        dataframe = parseObservations(html, full_url, date_insert)
+        # Only caching pages that have observations
+        atomicWrite(cache_path, html)
 
     # Adding date to the data
-    date_insert = "{year}-{month}-{day}".format(day=day, month=month, year=year)
-    dataframe[0].insert(0, "Date", date_insert)
+    dataframe.insert(0, "Date", date_insert)
 
-    return dataframe[0][:24]
+    return dataframe[:24]
 
 def getDates(start_date, end_date):
     """Generates a list of dates.
@@ -52,90 +133,149 @@ def getDates(start_date, end_date):
         end_date (string): yyyy-mm-dd
 
     returns:
-        list withh dates as strings
+        Pandas DatetimeIndex with one date per day
     """
-    # Generate a list of all of the dates we want data for
-    start = parser.parse(start_date)
-    end = parser.parse(end_date)
-    dates = list(rrule.rrule(rrule.DAILY, dtstart=start, until=end))
-    return dates
+    # Generate all of the dates we want data for
+    return pd.date_range(start_date, end_date, freq='D')
 
-def weatherStaionToCSV(data, station):
-    """Saves data from one weather station to a Comma Separated Values file (CSV file)
+def weatherStaionToEXCEL(station):
+    """Saves the raw data from one weather station to an Excel file for use in Unscrambler
 
     Args:
-        data (2D list): a list with weather stations and their data
         station (string): the station in question
     """
-    # Combine all of the individual days and output to CSV for analysis.
-    outname = '{}_raw_weather.csv'.format(station)
-    outdir = './data/'
-    if not os.path.exists(outdir):
-        os.mkdir(outdir)
-    fullname = os.path.join(outdir, outname) 
-    pd.concat(data[station]).to_csv(fullname)
+    # Convert the raw CSV to Excel for analysis, one chunk at a time so that it is never all in memory.
+    fullname = DATA_DIR / '{}_raw_weather.xlsx'.format(station)
+    chunks = pd.read_csv(DATA_DIR / '{}_raw_weather.csv'.format(station), chunksize=EXCEL_CHUNK_ROWS)
+    with pd.ExcelWriter(fullname, engine='xlsxwriter') as writer:
+        row = 0
+        for i, chunk in enumerate(chunks):
+            chunk.to_excel(writer, startrow=row, header=(i == 0), index=False)
+            row += len(chunk) + (i == 0)
 
-def weatherStaionToEXCEL(data, station):
-    """Saves data from one weather station to an Excel file for use in Unscrambler
+
+async def scrapeDate(session, semaphore, station, date):
+    """Scrapes the data for a single date, retrying with exponential backoff if a request fails
 
     Args:
-        data (2D list): a list with weather stations and their data
+        session (aiohttp.ClientSession): HTTP session used for the request
+        semaphore (asyncio.Semaphore): limits the number of concurrent requests
         station (string): the station in question
-    """
-    # Combine all of the individual days and output to CSV for analysis.
-    outname = '{}_raw_weather.csv'.format(station)
-    outdir = './data/'
-    if not os.path.exists(outdir):
-        os.mkdir(outdir)
-    fullname = os.path.join(outdir, outname) 
-    pd.concat(data[station]).to_excel(fullname)
+        date (pandas Timestamp): the date in question
 
+    returns:
+        Pandas Dataframe with weather data for specified station and date.
+    """
+    # Backoff time in seconds if a request fails, doubled on every retry up to MAX_BACKOFF_TIME
+    backoff_time = 1
+    async with semaphore:
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                return await getWundergroundData(session, station, date.day, date.month, date.year)
+            except (aiohttp.ClientError, asyncio.TimeoutError, NoObservationsError) as e:
+                if isinstance(e, aiohttp.ClientResponseError) and e.status < 500 and e.status != 429:
+                    raise
+                if attempt == MAX_ATTEMPTS:
+                    print("Giving up on {} after {} attempts".format(date, attempt))
+                    raise
+                retry_time = backoff_time
+                if isinstance(e, aiohttp.ClientResponseError):
+                    # May get rate limited by Wunderground.com, respect Retry-After if it is given.
+                    retry_after = e.headers.get('Retry-After') if e.headers else None
+                    if retry_after is not None and retry_after.isdigit():
+                        retry_time = max(retry_time, int(retry_after))
+                retry_time = min(retry_time, MAX_BACKOFF_TIME)
+                print("Got {} on {}: {}".format(type(e).__name__, date, e))
+                print("Will retry in {} seconds".format(retry_time))
+                await asyncio.sleep(retry_time)
+                backoff_time = min(backoff_time * 2, MAX_BACKOFF_TIME)
+
+async def scrapeDataAsync(station, dates, file):
+    """Scrapes all data corresponding to "dates" concurrently and writes it to "file" as CSV
 
-def scrapeDataToCSV(station, dates):
+    Args:
+        station (string): the station in question
+        dates (list of stirings): a list of dates 
+        file (file object): open text file the data is written to, in the same order as "dates"
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    # One connector for every date, so TCP and TLS connections are reused instead of being set up per request
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    # Only the HTML of the page is needed
+    headers = {'Accept': 'text/html', 'User-Agent': USER_AGENT}
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+
+    async def scrapeIndexed(session, i, date):
+        return i, await scrapeDate(session, semaphore, station, date)
+
+    async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
+        tasks = [asyncio.create_task(scrapeIndexed(session, i, date)) for i, date in enumerate(dates)]
+        try:
+            # Days finish in any order, each is written as soon as it and all days before it are done
+            finished = {}
+            written = 0
+            columns = None
+            for next_done in atqdm.as_completed(tasks, total=len(tasks)):
+                i, weather_data = await next_done
+                finished[i] = weather_data
+                while written in finished:
+                    weather_data = finished.pop(written)
+                    if columns is None:
+                        columns = list(weather_data.columns)
+                    elif set(weather_data.columns) != set(columns):
+                        raise ValueError("Columns on {} are {}, expected {}".format(
+                            dates[written], list(weather_data.columns), columns))
+                    # Every day is written in the columns of the first day, so values stay under their header
+                    weather_data.reindex(columns=columns).to_csv(file, header=(written == 0), index=False)
+                    written += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+
+def scrapeDataToCSV(station, dates, excel=False):
     """A function to scrape all data corresponding to "dates" and save the result
 
     Args:
         station (string): the station in question
         dates (list of stirings): a list of dates 
+        excel (bool): also save the result to an Excel file
     """
-    # Set a backoff time in seconds if a request fails
-    backoff_time = 10
-    data = {}
+    fullname = DATA_DIR / '{}_raw_weather.csv'.format(station)
 
-    # Gather data for each station in turn and save to CSV.
+    # Gather data for the station and stream it to CSV. The CSV is written to a temporary file
+    # first, so that a failed run does not replace the previous CSV with a partial one.
     print("Working on {}".format(station))
-    data[station] = []
-    for date in tqdm(dates):
-        # Print period status update messages
-        if date.day % 10 == 0:
-            print("\nWorking on date: {} for station {}".format(date, station))
-        done = False
-        while done == False:
-            try:
-                weather_data = getWundergroundData(station, date.day, date.month, date.year)
-                #print(weather_data)
-                done = True
-            except ConnectionError as e:
-                # May get rate limited by Wunderground.com, backoff if so.
-                print("Got connection error on {}".format(date))
-                print("Will retry in {} seconds".format(backoff_time))
-                time.sleep(10)
-        # Add each processed date to the overall data
-        data[station].append(weather_data)
-
-    #print(data)
-    weatherStaionToCSV(data, station)
-    weatherStaionToEXCEL(data, station)
-
-def processData(station):
+    fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', buffering=1 << 20, encoding='utf-8', newline='') as file:
+            asyncio.run(scrapeDataAsync(station, dates, file))
+        os.replace(tmp_path, fullname)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    if excel:
+        weatherStaionToEXCEL(station)
+
+def writeCSV(data, fullname):
+    """Writes a data frame to CSV with Arrow's vectorized writer, which is several times faster than to_csv for numeric data
+
+    Args:
+        data (pandas Dataframe): the data to write, the index is not written
+        fullname (pathlib.Path): the file to write
+    """
+    pyarrow.csv.write_csv(pyarrow.Table.from_pandas(data, preserve_index=False), str(fullname))
+
+def processData(station, excel=False):
     """Prosessing the data to make it suitable to further analysis.
 
     Args:
         station (string): the station in question
+        excel (bool): also save the result to an Excel file
     """
     csv_name = '{}_raw_weather.csv'.format(station)
-    # Loading CSV
-    data_raw = pd.read_csv('data/' + csv_name)
+    # Loading CSV with Arrow backed columns, so the string operations below run in Arrow's vectorized kernels
+    data_raw = pd.read_csv(DATA_DIR / csv_name, engine='pyarrow', dtype_backend='pyarrow')
 
     # Changing column names to something nice
     cols = {'Date' : 'Date', 
@@ -150,69 +290,106 @@ def processData(station):
     data_raw.rename(columns = cols, inplace=True)
 
     # Converting the data from string with unit to only a float number
-    data_raw['Time'] = data_raw['Time'].str.split(expand = True)[:][0]#.astype(float)
+    for col in ['Time', 'Temperature [F]', 'Dew Point [F]', 'Humidity [%]', 'Wind Speed [mph]',
+                'Wind Gust [mph]', 'Pressure [in]', 'Precipitation [inch]']:
+        # Keeping only the first word, as str.split()[0] would. Arrow needs the group to be named.
+        data_raw[col] = data_raw[col].str.extract(r'(?P<value>\S+)', expand = False)
     data_raw['Time'] = data_raw['Time'].str.replace(':', '.')
-    data_raw['Temperature [F]'] = data_raw['Temperature [F]'].str.split(expand = True)[:][0]#.astype(float)
-    data_raw['Dew Point [F]'] = data_raw['Dew Point [F]'].str.split(expand = True)[:][0]#.astype(float)
-    data_raw['Humidity [%]'] = data_raw['Humidity [%]'].str.split(expand = True)[:][0]#.astype(float)
-    data_raw['Wind Speed [mph]'] = data_raw['Wind Speed [mph]'].str.split(expand = True)[:][0]#.astype(float)
-    data_raw['Wind Gust [mph]'] = data_raw['Wind Gust [mph]'].str.split(expand = True)[:][0]#.astype(float)
-    data_raw['Pressure [in]'] = data_raw['Pressure [in]'].str.split(expand = True)[:][0].str.replace('.', ',')#.astype(float)
-    data_raw['Pressure [in]'] = data_raw['Pressure [in]'].str.replace('.', ',')
-    data_raw['Precipitation [inch]'] = data_raw['Precipitation [inch]'].str.split(expand = True)[:][0]#.astype(float)
+    for col in ['Temperature [F]', 'Dew Point [F]', 'Humidity [%]', 'Wind Speed [mph]',
+                'Wind Gust [mph]', 'Pressure [in]', 'Precipitation [inch]']:
+        data_raw[col] = pd.to_numeric(data_raw[col], errors = 'coerce')
 
     # Katmandu has no presipitation sensor; droppping the column
     data_raw = data_raw.drop('Precipitation [inch]', axis = 1)
 
     # Updating CSV with prosecced data
-    data_raw.to_csv('data/{}_processed_weather.csv'.format(station))
-    data_raw.to_excel('data/{}_processed_weather.xlsx'.format(station))
+    writeCSV(data_raw, DATA_DIR / '{}_processed_weather.csv'.format(station))
+    if excel:
+        data_raw.to_excel(DATA_DIR / '{}_processed_weather.xlsx'.format(station), engine='xlsxwriter')
+
+def generalizeConditions(names):
+    """Generalizes Wunderground conditions into the groups in CONDITION_GROUPS.
+
+    Args:
+        names (pandas Series): lower case conditions, with '' for missing ones
+
+    returns:
+        int8 numpy array with the index in CONDITION_GROUPS of each condition
+    """
+    conditions = []
+    for group in range(1, len(CONDITION_GROUPS)):
+        pattern = '|'.join(keyword for keyword, keyword_group in CONDITION_KEYWORDS if keyword_group == group)
+        conditions.append(names.str.contains(pattern, regex=True).to_numpy(dtype=bool))
+    return np.select(conditions, range(1, len(CONDITION_GROUPS)), default=0).astype(np.int8)
+
+def oneHot(column, categories):
+    """One Hot encodes a column without the overhead of pd.get_dummies.
 
-def oneHotEncode(station):
+    Args:
+        column (pandas Series): the column to encode
+        categories (list): the categories to make a column for, in order
+
+    returns:
+        Pandas Dataframe with one column of 0s and 1s per category
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # Comparing the integer codes instead of the strings. Categories the column does not
+        # have are given code -2, so that they do not match missing values (code -1).
+        values = column.cat.codes.to_numpy()
+        targets = column.cat.categories.get_indexer(categories)
+        targets[targets == -1] = -2
+    else:
+        values = column.to_numpy()
+        targets = categories
+    encoded = np.zeros((len(values), len(categories)), dtype=np.int8)
+    for i, target in enumerate(targets):
+        encoded[:, i] = values == target
+    return pd.DataFrame(encoded, columns=categories, index=column.index)
+
+def oneHotEncode(station, excel=False):
     """One HHot encodes the string variables that Wunderground returns.
+
+    Args:
+        station (string): the station in question
+        excel (bool): also save the result to an Excel file
     """
     csv_name = '{}_processed_weather.csv'.format(station)
     # Loading CSV
-    data_raw = pd.read_csv('data/' + csv_name)
+    data_raw = pd.read_csv(DATA_DIR / csv_name, engine='pyarrow', dtype_backend='pyarrow',
+                           dtype = {'Wind Direction' : 'category', 'Condition' : 'category'})
 
-    one_hot = pd.get_dummies(data_raw['Wind Direction'])
-    data_raw = data_raw.drop('Wind Direction', axis = 1)
-    data_raw = data_raw.join(one_hot)
+    wind_one_hot = oneHot(data_raw['Wind Direction'], data_raw['Wind Direction'].cat.categories)
     
     # Possible conditions : 
     # ['Cloudy', 'Drizzle', 'Fair', 'Fog', 'Heavy Rain', 'Heavy T-Storm', 'Light Rain', 'Light Rain with Thunder', 'Mostly Cloudy', 'Partly Cloudy', 'Rain', 'T-Storm', 'Thunder']
 
-    generalized_conditions = []
-
-    for item in data_raw['Condition']:
-        if type(item) != str:
-            generalized_conditions.append("Other")
-        elif "rain" in item.lower() or "drizzle" in item.lower() or "misty" in item.lower() or "storm" in item.lower() or "thunder" in item.lower():
-            generalized_conditions.append("Rain")
-        elif "cloudy" in item.lower() or "fog" in item.lower():
-            generalized_conditions.append("Cloudy")
-        elif "fair" in item.lower():
-            generalized_conditions.append("Sun")
-        else:
-            generalized_conditions.append("Other")
+    # Generalizing the few unique conditions, and then looking up the group of every row by its code
+    codes, uniques = pd.factorize(data_raw['Condition'])
+    names = pd.Series(uniques, dtype='string').str.lower()
+    # Missing conditions have code -1, which picks the 'Other' group appended at the end
+    groups = np.append(generalizeConditions(names), np.int8(CONDITION_GROUPS.index('Other')))
+    condition_groups = pd.Series(groups[codes], index=data_raw.index)
+    present_groups = sorted(np.unique(condition_groups), key=lambda group: CONDITION_GROUPS[group])
+    condition_one_hot = oneHot(condition_groups, present_groups)
+    condition_one_hot.columns = [CONDITION_GROUPS[group] for group in present_groups]
 
-    one_hot = pd.get_dummies(generalized_conditions)
-    data_raw = data_raw.drop('Condition', axis = 1)
-    data_raw = data_raw.join(one_hot)
+    data_raw = pd.concat([data_raw.drop(['Wind Direction', 'Condition'], axis = 1), wind_one_hot, condition_one_hot], axis = 1)
 
     # Updating CSV with prosecced data
-    data_raw.to_csv('data/{}_onehot_weather.csv'.format(station))
-    data_raw.to_excel('data/{}_onehot_weather.xlsx'.format(station))
+    writeCSV(data_raw, DATA_DIR / '{}_onehot_weather.csv'.format(station))
+    if excel:
+        data_raw.to_excel(DATA_DIR / '{}_onehot_weather.xlsx'.format(station), engine='xlsxwriter')
 
 def main():
     start_date = "2019-01-01"
     end_date = "2019-12-28"
     station = 'VNKT' # Khatmandu
+    excel = False # Excel files for Unscrambler are slow to write, only make them when needed
 
     dates = getDates(start_date, end_date)
-    #scrapeDataToCSV(station, dates)
-    processData(station)
-    oneHotEncode(station)
+    #scrapeDataToCSV(station, dates, excel)
+    processData(station, excel)
+    oneHotEncode(station, excel)
 
     
 